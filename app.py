@@ -3,10 +3,18 @@ import google.generativeai as genai
 import os
 from pathlib import Path
 import json
+import orjson
 import time
+import datetime
+import concurrent.futures
+import logging
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 import re
-import urllib.parse
+import base64
+import hashlib
+try: import xxhash
+except ImportError: xxhash = None
 
 
 st.set_page_config(layout="wide", page_title="Gemini Web Builder (React CDN)")
@@ -14,7 +22,12 @@ load_dotenv()
 
 WORKSPACE_DIR = Path("workspace")
 WORKSPACE_DIR.mkdir(exist_ok=True)
+WS_ROOT = WORKSPACE_DIR.resolve()
 CSS_FILENAME = "style.css"
+LARGE_PREVIEW_BYTES = 512 * 1024 # Above this, skip the data URI and only render inline on request
+try: HISTORY_WINDOW = max(1, int(os.getenv("GEMINI_HISTORY_WINDOW", "10"))) # Max past messages re-sent to Gemini per call
+except ValueError: HISTORY_WINDOW = 10
+_HEAD_RE = re.compile(r"</head>", re.IGNORECASE)
 
 
 try:
@@ -34,52 +47,129 @@ if "messages" not in st.session_state: st.session_state.messages = []
 if "selected_file" not in st.session_state: st.session_state.selected_file = None
 if "file_content" not in st.session_state: st.session_state.file_content = ""
 if "rendered_html" not in st.session_state: st.session_state.rendered_html = ""
+if "preview_data_uri" not in st.session_state: st.session_state.preview_data_uri = ""
+if "preview_size" not in st.session_state: st.session_state.preview_size = 0
+if "unsaved_content" not in st.session_state: st.session_state.unsaved_content = None
+if "pending_response" not in st.session_state: st.session_state.pending_response = None
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _list_workspace_files(mtime_ns):
+    # mtime_ns is only the cache key: the directory mtime changes whenever an entry is added or removed
+    with os.scandir(WORKSPACE_DIR) as it: return sorted(e.name for e in it if e.is_file()) # DirEntry.is_file() uses d_type, no per-entry stat
+
+def content_hash(data):
+    if isinstance(data, str): data = data.encode("utf-8")
+    if xxhash is not None: return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+def html_data_uri(html_bytes):
+    return f"data:text/html;base64,{base64.b64encode(html_bytes).decode('ascii')}"
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def inject_css(html_hash, css_hash, _html, _css):
+    # Keyed on the content hashes only: Streamlit skips hashing the underscore-prefixed args
+    head_match = _HEAD_RE.search(_html)
+    if not head_match: return None
+    injection_point = head_match.start()
+    return _html[:injection_point] + f"\n<style>\n{_css}\n</style>\n" + _html[injection_point:]
 
 def get_workspace_files():
-    try: return sorted([f.name for f in WORKSPACE_DIR.iterdir() if f.is_file()])
+    try: return _list_workspace_files(WORKSPACE_DIR.stat().st_mtime_ns)
     except Exception as e: st.error(f"Error listing workspace files: {e}"); return []
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def _read_file_cached(path, mtime_ns, size):
+    # mtime_ns/size are only cache keys: any save or delete changes them and forces a fresh read
+    # Normalize line endings like text-mode reads did, so CRLF files don't leak "\r" into the editor or Gemini history
+    return Path(path).read_bytes().decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+def _safe_path(filename):
+    # Resolve only to validate (this also rejects symlinks that point outside the workspace); callers operate on the
+    # unresolved path so deleting or overwriting a symlink acts on the link, not its target
+    filepath = WS_ROOT / filename
+    try: resolved = filepath.resolve(strict=False)
+    except (OSError, RuntimeError, ValueError): return None # ValueError: embedded NUL byte
+    return filepath if resolved.is_relative_to(WS_ROOT) and resolved != WS_ROOT else None
+
 def read_file_content(filename):
     if not filename: return None
-    if ".." in filename or filename.startswith(("/", "\\")): return None
-    filepath = WORKSPACE_DIR / filename
+    filepath = _safe_path(filename)
+    if filepath is None: return None
     try:
-        with open(filepath, "r", encoding="utf-8") as f: return f.read()
+        file_stat = filepath.stat()
+        return _read_file_cached(str(filepath), file_stat.st_mtime_ns, file_stat.st_size)
     except FileNotFoundError: return None
     except Exception as e: st.error(f"Error reading file '{filename}': {e}"); return None
 
+def _css_bytes():
+    # Kept in session state as (mtime_ns, bytes, text) so a static style.css is only read and decoded once per session
+    css_path = _safe_path(CSS_FILENAME)
+    if css_path is None: return None, None
+    try:
+        css_mtime_ns = css_path.stat().st_mtime_ns
+        cached = st.session_state.get("_css_cache")
+        if cached and cached[0] == css_mtime_ns: return cached[1], cached[2]
+        data = css_path.read_bytes(); text = data.decode("utf-8")
+        st.session_state["_css_cache"] = (css_mtime_ns, data, text); return data, text
+    except FileNotFoundError: st.session_state.pop("_css_cache", None); return None, None
+    except Exception as e: st.error(f"Error reading file '{CSS_FILENAME}': {e}"); return None, None
+
 def save_file_content(filename, content):
     if not filename: return False
-    if ".." in filename or filename.startswith(("/", "\\")): return False
-    filepath = WORKSPACE_DIR / filename
+    filepath = _safe_path(filename)
+    if filepath is None: return False
     try:
         filepath.parent.mkdir(parents=True, exist_ok=True)
-        with open(filepath, "w", encoding="utf-8") as f: f.write(content); return True
+        data = content.encode("utf-8")
+        with open(filepath, "wb") as f: f.write(data); return True
     except Exception as e: st.error(f"Error saving file '{filename}': {e}"); return False
 
 def delete_file(filename):
     if not filename: return False
-    if ".." in filename or filename.startswith(("/", "\\")): return False
-    filepath = WORKSPACE_DIR / filename
+    filepath = _safe_path(filename)
+    if filepath is None: return False
     try:
         os.remove(filepath)
         if st.session_state.selected_file == filename: # Clear state if selected file is deleted
             st.session_state.selected_file = None
             st.session_state.file_content = ""
             st.session_state.rendered_html = ""
-            st.session_state.pop(f"rendered_for_{filename}", None)
+            st.session_state.pop(f"rendered_for_{filename}", None); st.session_state.pop(f"react_{filename}", None)
         return True
     except FileNotFoundError: st.warning(f"File '{filename}' not found for deletion."); return False
     except Exception as e: st.error(f"Error deleting file '{filename}': {e}"); return False
 
 
-def parse_and_execute_commands(ai_response_text):
+def strip_code_fence(text):
+    text = text.strip()
+    if text.startswith("```json"): return text[7:-3].strip()
+    if text.startswith("```"): return text[3:-3].strip()
+    return text
+
+def collect_stream(response, progress):
+    # Accumulate into a list (O(n) overall) and only attempt a parse when the current chunk ends in "]",
+    # since a response is complete only once its top-level JSON array closes
+    # Runs on the executor thread, so it reports through the shared progress dict instead of st.* calls
+    chunks = []
+    for chunk in response:
+        if progress["cancel"]: return None
+        text = chunk.text
+        if not text: continue
+        chunks.append(text)
+        progress["size"] += len(text); progress["tail"] = "".join(chunks[-4:])[-300:]
+        if text.rstrip().endswith("]"):
+            text = "".join(chunks)
+            try: return text, orjson.loads(text.encode("utf-8")) # Complete JSON received: stop waiting and hand over the parse
+            except orjson.JSONDecodeError: pass
+    return "".join(chunks), None
+
+
+def parse_and_execute_commands(ai_response_text, commands=None):
     parsed_commands = []
     try:
-        response_text_cleaned = ai_response_text.strip()
-        if response_text_cleaned.startswith("```json"): response_text_cleaned = response_text_cleaned[7:-3].strip()
-        elif response_text_cleaned.startswith("```"): response_text_cleaned = response_text_cleaned[3:-3].strip()
-        commands = json.loads(response_text_cleaned) # Strict parsing
+        if commands is None: # Only parse when the stream didn't already yield the commands (e.g. fenced output)
+            response_text_cleaned = strip_code_fence(ai_response_text)
+            commands = orjson.loads(response_text_cleaned.encode("utf-8")) # Strict parsing
         if not isinstance(commands, list): return [{"action": "chat", "content": f"AI (Non-list JSON): {ai_response_text}"}]
         for command in commands:
             if not isinstance(command, dict): parsed_commands.append({"action": "chat", "content": f"Skipped: {command}"}); continue
@@ -95,7 +185,7 @@ def parse_and_execute_commands(ai_response_text):
             elif action=="chat": pass
             else: st.warning(f"⚠️ Unknown action '{action}': {command}")
         return parsed_commands
-    except json.JSONDecodeError as e:
+    except (json.JSONDecodeError, orjson.JSONDecodeError) as e:
         st.error(f"🔴 Invalid JSON: {e}\nTxt:\n'{ai_response_text[:500]}...'")
         return [{"action": "chat", "content": f"AI(Invalid JSON): {ai_response_text}"}]
     except Exception as e:
@@ -103,13 +193,7 @@ def parse_and_execute_commands(ai_response_text):
         return [{"action": "chat", "content": f"Error processing commands: {e}"}]
 
 
-def call_gemini(history):
-    safe_history = []
-    for msg in history:
-        if isinstance(msg, dict) and "role" in msg and "content" in msg:
-            safe_history.append({"role": msg["role"], "content": str(msg["content"])})
-
-    instruction = """
+INSTRUCTION = """
     You are an AI assistant that helps users create web pages and simple web applications.
     Your goal is to generate HTML, CSS, JavaScript code, or self-contained React preview files.
     Based on the user's request, you MUST respond ONLY with a valid JSON array containing file operation objects.
@@ -141,64 +225,138 @@ def call_gemini(history):
     **GENERAL:**
     Use standard filenames ('index.html', 'style.css', 'script.js'). The standard CSS file for injection is 'style.css'. If unsure, ask the user. Respond ONLY with the JSON array. Use 'chat' action for questions or explanations.
     """
-    current_files = get_workspace_files()
+
+_INSTRUCTION_PREFIX = INSTRUCTION + "\n" # The instruction contains JSON braces, so the file list is appended rather than str.format-ed in
+_MODEL_ACK = '[{"action": "chat", "content": "Okay, I understand the strict JSON formatting rules (double quotes, escaping) and the need to provide full file content on updates. I will respond only with the valid JSON array. Ready."}]'
+_MODEL_ACK_TURN = {"role": "model", "parts": ({"text": _MODEL_ACK},)}
+
+CACHE_TTL_SECONDS = 3600
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "").lower() in ("1", "true", "yes") # Opt-in: the built-in instruction is below every model's minimum
+try: CACHE_MIN_TOKENS = max(0, int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "4096"))) # Gemini rejects cached content below the model's minimum size
+except ValueError: CACHE_MIN_TOKENS = 4096
+
+@st.cache_resource(ttl=CACHE_TTL_SECONDS - 300, show_spinner=False) # Refresh before the server-side cache expires
+def _create_cached_instruction_model(model_name):
+    # Errors propagate so Streamlit doesn't cache them; a too-small prefix is a stable answer and is cached as None
+    if model.count_tokens(INSTRUCTION).total_tokens < CACHE_MIN_TOKENS: return None
+    cache = genai.caching.CachedContent.create(model=model_name, system_instruction=INSTRUCTION, ttl=datetime.timedelta(seconds=CACHE_TTL_SECONDS))
+    return genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+def get_cached_instruction_model(model_name):
+    # None means send the instruction inline
+    if not CONTEXT_CACHE_ENABLED: return None
+    try: return _create_cached_instruction_model(model_name)
+    except google_exceptions.GoogleAPIError as e:
+        logging.getLogger(__name__).warning("Gemini context caching unavailable for '%s': %s", model_name, e)
+        st.session_state.cache_notice = f"⚠️ Context caching unavailable, sending instruction inline: {e}" # Shown in the sidebar after the rerun
+        return None
+
+
+@st.cache_resource
+def get_gemini_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def generate_in_background(active_model, gemini_history, progress):
+    response = active_model.generate_content(gemini_history, stream=True)
+    return collect_stream(response, progress)
+
+def gemini_error_response(e):
+    if "429" in str(e): st.error("🔴 Gemini API Quota/Rate Limit Exceeded.")
+    else: st.error(f"🔴 Gemini API call failed: {e}")
+    error_content = f"Error calling AI: {str(e)}".replace('"',"'"); return orjson.dumps([{"action": "chat", "content": error_content}]).decode()
+
+
+def call_gemini(history, current_files):
+    safe_history = []
+    for msg in history[-HISTORY_WINDOW:]:
+        if isinstance(msg, dict) and "role" in msg and "content" in msg:
+            content = msg["content"] if isinstance(msg["content"], list) else str(msg["content"])
+            safe_history.append({"role": msg["role"], "content": content})
+    while safe_history and safe_history[0]["role"] != "user": safe_history.pop(0) # Window must open on a user turn
+
     file_list_prompt = f"Current files in workspace: {', '.join(current_files) if current_files else 'None'}"
-    gemini_history = []
-    gemini_history.append({"role": "user", "parts": [{"text": f"{instruction}\n{file_list_prompt}"}]})
-    gemini_history.append({"role": "model", "parts": [{"text": '[{"action": "chat", "content": "Okay, I understand the strict JSON formatting rules (double quotes, escaping) and the need to provide full file content on updates. I will respond only with the valid JSON array. Ready."}]'}]})
+    cached_model = get_cached_instruction_model(model_name)
+    prefix_text = file_list_prompt if cached_model is not None else _INSTRUCTION_PREFIX + file_list_prompt
+    gemini_history = [{"role": "user", "parts": ({"text": prefix_text},)}, _MODEL_ACK_TURN]
     for msg in safe_history:
         role = "user" if msg["role"] == "user" else "model"; content_text = msg["content"]
         if role == "model" and isinstance(msg["content"], list):
-            try: content_text = json.dumps(msg["content"])
+            try: content_text = orjson.dumps(msg["content"]).decode()
             except Exception: content_text = str(msg["content"])
         gemini_history.append({"role": role, "parts": [{"text": content_text}]})
-    try:
-        response = model.generate_content(gemini_history); return response.text
-    except Exception as e:
-        if "429" in str(e): st.error("🔴 Gemini API Quota/Rate Limit Exceeded.")
-        else: st.error(f"🔴 Gemini API call failed: {e}")
-        error_content = f"Error calling AI: {str(e)}".replace('"',"'"); return json.dumps([{"action": "chat", "content": error_content}])
-
+    progress = {"size": 0, "tail": "", "cancel": False}
+    future = get_gemini_executor().submit(generate_in_background, cached_model or model, gemini_history, progress)
+    return {"future": future, "progress": progress}
+
+
+def finish_pending_response():
+    pending = st.session_state.pending_response
+    if pending is None or not pending["future"].done(): return
+    st.session_state.pending_response = None
+    try: result = pending["future"].result()
+    except Exception as e: result = (gemini_error_response(e), None)
+    if result is None: executed_commands = [{"action": "chat", "content": "Generation stopped."}]
+    else: executed_commands = parse_and_execute_commands(*result)
+    st.session_state.messages.append({"role": "assistant", "content": executed_commands, "display": format_commands_for_display(executed_commands)})
+
+@st.fragment(run_every=1) # Polls the background call; only registered while a response is pending
+def pending_response_status():
+    pending = st.session_state.pending_response
+    if pending is None: return
+    if pending["future"].done(): st.rerun() # Full rerun applies the commands and refreshes files and preview
+    progress = pending["progress"]
+    with st.chat_message("assistant"):
+        st.caption(f"🧠 AI Thinking... {progress['size']:,} chars received")
+        if progress["tail"]: st.caption(f"…{progress['tail']}")
+        # The worker only sees the flag between chunks, so nothing can interrupt the wait for the first token
+        if st.button("⏹️ Stop", disabled=progress["cancel"], help="Takes effect once the response starts streaming."): progress["cancel"] = True
+        if progress["cancel"] and not progress["size"]: st.caption("Stop requested - waiting for the model to start streaming before it can be abandoned.")
+
+
+def format_commands_for_display(commands):
+    # Built once when the assistant message is stored so the sidebar doesn't rebuild it on every rerun
+    display_lines = []; chat_messages = []
+    for command in commands:
+        if not isinstance(command, dict): continue
+        action = command.get("action"); filename = command.get("filename")
+        if action == "create_update": display_lines.append(f"📝 Create/Update: `{filename}`\n")
+        elif action == "delete": display_lines.append(f"🗑️ Delete: `{filename}`\n")
+        elif action == "chat": chat_messages.append(command.get('content', '...'))
+        else: display_lines.append(f"⚠️ {command.get('content', f'Unknown action: {action}')}\n")
+    final_display = ("".join(display_lines) + "\n".join(chat_messages)).strip()
+    return final_display or "(No action)"
+
+
+with st.sidebar: finish_pending_response()
+workspace_files = get_workspace_files()
 
 with st.sidebar:
     st.header("💬 Chat with AI")
     st.markdown("Ask the AI to create or modify web files (HTML, CSS, JS, React CDN Previews).")
     st.caption(f"Using Model: `{model_name}`")
+    if cache_notice := st.session_state.pop("cache_notice", None): st.warning(cache_notice)
     chat_container = st.container(height=500)
     with chat_container:
         if st.session_state.messages:
             for message in st.session_state.messages:
                 with st.chat_message(message["role"]):
-                    if isinstance(message.get("content"), list) and message.get("role") == "assistant":
-                        display_text = ""; chat_messages = []
-                        for command in message["content"]:
-                            if not isinstance(command, dict): continue
-                            action = command.get("action"); filename = command.get("filename")
-                            if action == "create_update": display_text += f"📝 Create/Update: `{filename}`\n"
-                            elif action == "delete": display_text += f"🗑️ Delete: `{filename}`\n"
-                            elif action == "chat": chat_messages.append(command.get('content', '...'))
-                            else: display_text += f"⚠️ {command.get('content', f'Unknown action: {action}')}\n"
-                        final_display = (display_text + "\n".join(chat_messages)).strip()
-                        if not final_display: final_display = "(No action)"
-                        st.markdown(final_display)
+                    if "display" in message: st.markdown(message["display"])
                     else: st.write(str(message.get("content", "")))
         else: st.info("Chat history empty.")
-    if prompt := st.chat_input("e.g., Create index.html with a title"):
+        if st.session_state.pending_response is not None: pending_response_status()
+    if prompt := st.chat_input("e.g., Create index.html with a title", disabled=st.session_state.pending_response is not None):
         st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.spinner("🧠 AI Thinking..."):
-            ai_response_text = call_gemini(st.session_state.messages)
-            executed_commands = parse_and_execute_commands(ai_response_text)
-            st.session_state.messages.append({"role": "assistant", "content": executed_commands})
-            st.rerun()
+        st.session_state.pending_response = call_gemini(st.session_state.messages, workspace_files)
+        st.rerun()
 
-st.title("🤖 AI Web Builder (React CDN Preview)")
-tab1, tab2 = st.tabs([" 📂 Workspace ", " 👀 Preview "])
+def stash_editor_content(editor_key):
+    st.session_state.unsaved_content = st.session_state[editor_key]
 
-with tab1:
+@st.fragment # Editor interactions rerun only this block, not the sidebar chat or preview
+def workspace_editor(available_files):
     st.header("Workspace & Editor")
     st.markdown("---")
     st.subheader("Files")
-    available_files = get_workspace_files()
     if not available_files: st.info(f"Workspace '{WORKSPACE_DIR.name}' empty.")
     current_selection_index = 0; options = [None] + available_files
     if st.session_state.selected_file in options:
@@ -210,25 +368,30 @@ with tab1:
     if selected_file_option != st.session_state.selected_file:
         st.session_state.selected_file = selected_file_option
         st.session_state.file_content = read_file_content(st.session_state.selected_file) or "" if st.session_state.selected_file else ""
-        st.session_state.rendered_html = ""; st.session_state.pop(f"rendered_for_{st.session_state.selected_file}", None)
+        st.session_state.rendered_html = ""; st.session_state.pop(f"rendered_for_{st.session_state.selected_file}", None); st.session_state.pop(f"react_{st.session_state.selected_file}", None)
+        st.session_state.unsaved_content = None
         st.rerun()
     if st.session_state.selected_file:
         st.caption(f"Editing: `{st.session_state.selected_file}`")
-        file_ext = Path(st.session_state.selected_file).suffix.lower()
-        lang_map = {".html": "html", ".css": "css", ".js": "javascript", ".py":"python", ".md": "markdown", ".json": "json", ".jsx":"javascript", ".vue":"vue", ".svelte":"svelte", ".txt":"text"}
-        language = lang_map.get(file_ext)
-        edited_content = st.text_area("Code Editor", value=st.session_state.file_content, height=400, key=editor_key, label_visibility="collapsed", args=(language,))
-        if edited_content != st.session_state.file_content:
+        st.text_area("Code Editor", value=st.session_state.file_content, height=400, key=editor_key, label_visibility="collapsed", on_change=stash_editor_content, args=(editor_key,))
+        edited_content = st.session_state.unsaved_content
+        if edited_content is not None and edited_content != st.session_state.file_content:
              if st.button("💾 Save Manual Changes"):
                 if save_file_content(st.session_state.selected_file, edited_content):
-                    st.session_state.file_content = edited_content; st.success(f"Saved: `{st.session_state.selected_file}`")
-                    st.session_state.rendered_html = ""; st.session_state.pop(f"rendered_for_{st.session_state.selected_file}", None)
-                    time.sleep(0.5); st.rerun()
+                    st.session_state.file_content = edited_content; st.session_state.unsaved_content = None; st.success(f"Saved: `{st.session_state.selected_file}`")
+                    st.session_state.rendered_html = ""; st.session_state.pop(f"rendered_for_{st.session_state.selected_file}", None); st.session_state.pop(f"react_{st.session_state.selected_file}", None)
+                    time.sleep(0.5); st.rerun() # Full app rerun so the Preview tab picks up the saved file
                 else: st.error("Failed to save.")
     else:
         st.info("Select a file to edit.")
         st.text_area("Code Editor", value="Select a file...", height=400, key="editor_placeholder", disabled=True, label_visibility="collapsed")
 
+st.title("🤖 AI Web Builder (React CDN Preview)")
+tab1, tab2 = st.tabs([" 📂 Workspace ", " 👀 Preview "])
+
+with tab1:
+    workspace_editor(workspace_files)
+
 with tab2:
     st.header("Live Preview")
     st.markdown("---")
@@ -238,33 +401,36 @@ with tab2:
         if st.session_state.selected_file.lower().endswith(('.html', '.htm')):
             current_file_content_for_preview = read_file_content(st.session_state.selected_file)
             rendered_marker_key = f"rendered_for_{st.session_state.selected_file}"
-            needs_render_update = False
+            react_marker_key = f"react_{st.session_state.selected_file}"
+            needs_render_update = False; current_preview_hash = None; css_bytes = css_text = None
             if current_file_content_for_preview is not None:
-                 needs_render_update = (not st.session_state.rendered_html or st.session_state.get(rendered_marker_key) != current_file_content_for_preview)
+                 css_bytes, css_text = _css_bytes()
+                 current_preview_hash = (content_hash(current_file_content_for_preview), content_hash(css_bytes) if css_bytes else None)
+                 needs_render_update = (not st.session_state.rendered_html or st.session_state.get(rendered_marker_key) != current_preview_hash)
             else:
-                 st.session_state.rendered_html = ""; st.session_state.pop(rendered_marker_key, None)
+                 st.session_state.rendered_html = ""; st.session_state.pop(rendered_marker_key, None); st.session_state.pop(react_marker_key, None)
 
             if needs_render_update:
                 if current_file_content_for_preview is not None:
                     final_html = current_file_content_for_preview
-                    is_react_cdn_preview = "<script src=\"https://unpkg.com/@babel/standalone" in final_html
+                    is_react_cdn_preview = "@babel/standalone" in final_html # Detected once per render, reused by the preview note
+                    st.session_state[react_marker_key] = is_react_cdn_preview
                     css_applied_info = ""
-                    if not is_react_cdn_preview:
-                        css_content = read_file_content(CSS_FILENAME)
-                        if css_content:
-                            style_tag = f"\n<style>\n{css_content}\n</style>\n"
-                            head_match = re.search(r"</head>", final_html, re.IGNORECASE)
-                            if head_match:
-                                injection_point = head_match.start()
-                                final_html = final_html[:injection_point] + style_tag + final_html[injection_point:]
-                                css_applied_info = f"🎨 Injected `{CSS_FILENAME}`."
+                    if not is_react_cdn_preview and css_bytes:
+                        injected_html = inject_css(*current_preview_hash, final_html, css_text)
+                        if injected_html is not None:
+                            final_html = injected_html
+                            css_applied_info = f"🎨 Injected `{CSS_FILENAME}`."
                     st.session_state.rendered_html = final_html
-                    st.session_state[rendered_marker_key] = current_file_content_for_preview
+                    html_bytes = final_html.encode("utf-8"); st.session_state.preview_size = len(html_bytes)
+                    # Encoded once per render and reused on every rerun; large pages would blow past browser URL limits
+                    st.session_state.preview_data_uri = html_data_uri(html_bytes) if len(html_bytes) <= LARGE_PREVIEW_BYTES else ""
+                    st.session_state[rendered_marker_key] = current_preview_hash
 
                 else:
                     st.warning(f"Could not read `{st.session_state.selected_file}` for preview.")
                     st.session_state.rendered_html = "Error reading file for preview."
-                    st.session_state.pop(rendered_marker_key, None)
+                    st.session_state.pop(rendered_marker_key, None); st.session_state.pop(react_marker_key, None)
 
 
             if st.session_state.rendered_html and "Error reading file" not in st.session_state.rendered_html:
@@ -273,18 +439,23 @@ with tab2:
 
                 try:
 
-                    encoded_html = urllib.parse.quote(st.session_state.rendered_html)
-                    data_uri = f"data:text/html;charset=utf-8,{encoded_html}"
-                    st.markdown(f'<a href="{data_uri}" target="_blank" rel="noopener noreferrer"><button>🚀 Open Preview in New Window</button></a>', unsafe_allow_html=True)
-                    st.caption("_(Uses Data URI - best for self-contained HTML/CSS/JS)_")
+                    data_uri = st.session_state.preview_data_uri
+                    if data_uri:
+                        st.markdown(f'<a href="{data_uri}" target="_blank" rel="noopener noreferrer"><button>🚀 Open Preview in New Window</button></a>', unsafe_allow_html=True)
+                        st.caption("_(Uses Data URI - best for self-contained HTML/CSS/JS)_")
+                    else:
+                        st.download_button("⬇️ Download Preview HTML", data=st.session_state.rendered_html, file_name=Path(st.session_state.selected_file).name, mime="text/html")
+                        st.caption(f"_(Page is {st.session_state.preview_size / 1024:,.0f} KB - too large for a Data URI; open the downloaded file instead)_")
                 except Exception as e:
                     st.warning(f"Could not create 'Open in New Window' link: {e}")
 
 
-                st.components.v1.html(st.session_state.rendered_html, height=600, scrolling=True)
+                if st.session_state.preview_size <= LARGE_PREVIEW_BYTES or st.toggle(f"Render large page inline ({st.session_state.preview_size / 1024:,.0f} KB)", key=f"render_large_{st.session_state.selected_file}"):
+                    st.components.v1.html(st.session_state.rendered_html, height=600, scrolling=True)
                 st.markdown("---")
+                is_react_cdn_preview = st.session_state.get(react_marker_key, False)
                 preview_note = "Note: Basic HTML Preview."
-                if "<script src=\"https://unpkg.com/@babel/standalone" in st.session_state.rendered_html:
+                if is_react_cdn_preview:
                      preview_note = "Note: Preview uses CDN links & in-browser transpiling for simple React demos."
 
                 if not is_react_cdn_preview and f"Injected `{CSS_FILENAME}`" in css_applied_info:
@@ -297,7 +468,7 @@ with tab2:
         else: # File selected, but not HTML
             st.info(f"Preview is available for HTML files only. Selected: `{st.session_state.selected_file}`")
             st.session_state.rendered_html = ""
-            st.session_state.pop(f"rendered_for_{st.session_state.selected_file}", None)
+            st.session_state.pop(f"rendered_for_{st.session_state.selected_file}", None); st.session_state.pop(f"react_{st.session_state.selected_file}", None)
     else: # No file selected
         st.info("Select an HTML file from the 'Workspace' tab to see a preview.")
         st.session_state.rendered_html = ""